@@ -1,30 +1,68 @@
 import vlc
 import time
+import subprocess
+from keyframe_index import KeyframeIndex
 
 class VLCMediaPlayer():
     def __init__(self):
         self.instance = vlc.Instance()
         self.player = self.instance.media_player_new()
         self.current_video = None
+        self.paths = {}
+        self.indexes = {}
+        self.pending_seek = None
 
     def load_videos(self, path_not_triggered, path_triggered):
         self.normal_vid = vlc.Media(path_not_triggered)
         self.trigger_vid = vlc.Media(path_triggered)
 
+        self.paths[self.normal_vid] = path_not_triggered
+        self.paths[self.trigger_vid] = path_triggered
+
         # This is supposed to "pre-parse" the videos before playing it.
         # The performance improvement is very low but that doesn't hurt!
         self.normal_vid.parse()
         self.trigger_vid.parse()
 
-    def play_video(self, media):
+        # Keyframe positions and cue points, used to start mid-clip. Built now
+        # since it runs ffprobe over the whole file.
+        for media, path in self.paths.items():
+            try:
+                self.indexes[media] = KeyframeIndex.load(path)
+            except (OSError, subprocess.SubprocessError) as e:
+                print(f"Warning: No keyframe index for '{path}', mid-clip starts disabled: {e}")
+
+    def play_video(self, media, start_frame=0):
+        if start_frame:
+            # The index gives us the exact time of the frame, VLC then only
+            # decodes from the keyframe before it
+            start_ms = int(self.get_index(media).time_of(start_frame) * 1000)
+
         # You need to call "set_media()" to (re)load a video before playing it
         self.player.set_media(media)
         self.player.play()
         self.current_video = media
 
+        # VLC ignores set_time() until the video is actually playing,
+        # update() does the seek once it is
+        self.pending_seek = start_ms if start_frame else None
+
+    def play_cue(self, media, name):
+        self.play_video(media, self.get_index(media).cue(name))
+
+    def get_index(self, media):
+        if media not in self.indexes:
+            raise ValueError(f"Error: No keyframe index for '{self.paths[media]}', can't start mid-clip")
+        return self.indexes[media]
+
     def update(self, triggered):
         current_video = self.get_current_video()
 
+        # Start mid-clip as soon as VLC is playing
+        if self.pending_seek is not None and self.player.get_state() == vlc.State.Playing:
+            self.player.set_time(self.pending_seek)
+            self.pending_seek = None
+
         # Change video if needed
         if triggered and current_video == self.normal_vid:
             self.play_video(trigger_vid)
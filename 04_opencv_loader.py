@@ -3,14 +3,41 @@ import numpy as np
 import time
 import os
 from ffpyplayer.player import MediaPlayer
-from typing import Optional
+from typing import Optional, Union
+from keyframe_index import KeyframeIndex
 
 # --- Constants ---
 DEFAULT_FPS = 30
 SYNC_THRESHOLD_SEC = 0.01 # Sync if video is ahead by more than 10ms
 MIN_WAIT_MS = 1
 
-def play_video_with_audio(video_path: str, window_name: str = "Video") -> None:
+def seek_capture(video: cv2.VideoCapture, index: KeyframeIndex, frame: int) -> None:
+    """
+    Moves the capture to a frame, only decoding from the closest keyframe before it.
+
+    Args:
+        video: An opened capture of the indexed video.
+        index: Keyframe index of the video.
+        frame: Frame number to seek to, the next read() returns this frame.
+    """
+    target = index.time_of(frame) # Also checks the frame is in the video
+    keyframe = index.keyframe_before(frame)
+
+    # Seeking to a keyframe doesn't need to decode anything before it
+    video.set(cv2.CAP_PROP_POS_MSEC, index.time_of(keyframe) * 1000)
+    if frame == keyframe:
+        return
+
+    # Decode forward until the frame just before the target is reached,
+    # comparing timestamps (with half a frame of margin) rather than frame numbers
+    previous = index.time_of(frame - 1)
+    margin = (target - previous) / 2
+    while video.grab():
+        if video.get(cv2.CAP_PROP_POS_MSEC) / 1000 >= previous - margin:
+            break
+
+def play_video_with_audio(video_path: str, window_name: str = "Video",
+                          start: Union[int, str] = 0) -> None:
     """
     Plays a video file with audio using OpenCV for video and ffpyplayer for audio.
     Attempts synchronization based on player PTS. Resources are cleaned up automatically.
@@ -18,6 +45,7 @@ def play_video_with_audio(video_path: str, window_name: str = "Video") -> None:
     Args:
         video_path: Path to the video file.
         window_name: Name for the OpenCV display window.
+        start: Frame number or name of the cue point to start the playback from.
     """
     video: Optional[cv2.VideoCapture] = None
     player: Optional[MediaPlayer] = None
@@ -38,6 +66,16 @@ def play_video_with_audio(video_path: str, window_name: str = "Video") -> None:
             audio_enabled = False
             player = None # Ensure player is None if init fails
 
+        # --- Mid-clip start ---
+        if start:
+            index = KeyframeIndex.load(video_path)
+            start_frame = index.cue(start) if isinstance(start, str) else start
+            seek_capture(video, index, start_frame)
+            if player:
+                # Same timestamp as the video so both start on the same frame
+                player.seek(index.time_of(start_frame), relative=False)
+            print(f"Starting '{os.path.basename(video_path)}' at frame {start_frame}")
+
         fps = video.get(cv2.CAP_PROP_FPS)
         if fps <= 0:
             print(f"Warning: Could not read FPS from video. Using default: {DEFAULT_FPS}")
@@ -113,6 +151,8 @@ def play_video_with_audio(video_path: str, window_name: str = "Video") -> None:
 
     except IOError as e: # Handle errors opening video
         print(e)
+    except (ValueError, KeyError) as e: # Handle invalid start frames or cue points
+        print(e.args[0])
     except cv2.error as e: # Handle OpenCV specific errors
         print(f"OpenCV error during playback: {e}")
     except Exception as e: # Catch other unexpected errors
@@ -4,6 +4,16 @@ import RPi.GPIO as GPIO
 import time
 import os
 import fcntl
+import mmap
+import ctypes
+import ctypes.util
+import resource
+import json
+import shutil
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from keyframe_index import KeyframeIndex
 
 BUTTON_PIN = 40
 FBIO_WAITFORVSYNC = 1074021920 # TODO: Make it nicer
@@ -12,16 +22,345 @@ FBIO_WAITFORVSYNC = 1074021920 # TODO: Make it nicer
 # Could be easily improved but your get the idea!
 FPS = 0
 
+# How the decoded frames are stored:
+# - "heap":   plain numpy buffer, the kernel may page it out under memory pressure
+# - "pinned": anonymous mapping backed by huge pages when possible, locked in RAM
+#             with mlock() (raise "ulimit -l" or the lock will fail)
+# - "memmap": frames are cached next to the video (video1.mp4.fb565) and
+#             paged in from disk, PREFETCH_FRAMES ahead of the playback
+FRAME_STORE_MODE = "pinned"
+PREFETCH_FRAMES = 8
+
+# How the decoded frames are converted to the framebuffer format:
+# - "yuv":    ffmpeg hands us the raw YUV420 decoder output and we convert it
+#             straight to RGB565, split in row bands across all the cores
+# - "opencv": OpenCV converts to BGR, then a second pass converts to BGR565
+CONVERSION = "yuv"
+BENCHMARK_FRAMES = 100
+
+# How a clip continues after its last frame: "loop", "pingpong" or "reverse"
+IDLE_LOOP_MODE = "loop"
+TRIGGER_LOOP_MODE = "loop"
+# Restart the idle video where it was stopped instead of from its first frame
+RESUME_IDLE = True
+# Cue point of video2.mp4 to start from when triggered (see keyframe_index.py),
+# None to start from the first frame
+TRIGGER_CUE = None
+
+libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
 def check_sensor_state():
 	# Wait 25ms to mock a slow sensor
 	# time.sleep(0.025)
 
 	return (GPIO.input(BUTTON_PIN) == GPIO.LOW)
 
+def lock_pages(buf):
+	# mlock() also faults every page in, so no stall on the first playback
+	addr = ctypes.c_void_p(buf.ctypes.data)
+	if libc.mlock(addr, ctypes.c_size_t(buf.nbytes)) != 0:
+		err = ctypes.get_errno()
+		print(f"Warning: could not lock {buf.nbytes >> 20}MB in RAM: {os.strerror(err)}")
+
+def backing_mmap(buf):
+	# Walk up the numpy views until we find the mmap holding the frames
+	base = buf
+	while base is not None and not isinstance(base, mmap.mmap):
+		base = getattr(base, "base", None)
+	return base
+
+def cache_stamp(path, conversion):
+	# Same idea as the keyframe index: the cached frames are only valid
+	# for this exact video file, converted the same way
+	stat = os.stat(path)
+	return {"size": stat.st_size, "mtime": stat.st_mtime, "conversion": conversion}
+
+def load_frame_cache(path, conversion):
+	cache_path = path + ".fb565"
+	try:
+		with open(cache_path + ".json") as f:
+			stamp = json.load(f)
+		shape = tuple(stamp.pop("shape"))
+	except (OSError, ValueError, KeyError, TypeError):
+		return None
+
+	if stamp != cache_stamp(path, conversion) or not os.path.exists(cache_path):
+		return None
+	if os.path.getsize(cache_path) != int(np.prod(shape)):
+		return None
+
+	return np.memmap(cache_path, dtype='uint8', mode='r', shape=shape)
+
+def save_frame_cache(path, buf, conversion):
+	# Frames are written to a temporary file, it only replaces the cache once
+	# every frame is there so an interrupted load can't be mistaken for a cache
+	buf.flush()
+	# The store is cut down when the video has less frames than announced
+	os.truncate(path + ".fb565.tmp", buf.nbytes)
+	os.replace(path + ".fb565.tmp", path + ".fb565")
+
+	stamp = cache_stamp(path, conversion)
+	stamp["shape"] = list(buf.shape)
+	with open(path + ".fb565.json", "w") as f:
+		json.dump(stamp, f)
+
+	# Reopen read-only so the pages can be dropped and read back from the file
+	return np.memmap(path + ".fb565", dtype='uint8', mode='r', shape=buf.shape)
+
+def alloc_frame_store(path, shape, conversion):
+	size = int(np.prod(shape))
+
+	if FRAME_STORE_MODE == "pinned":
+		mem = mmap.mmap(-1, size, flags=mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS)
+		try:
+			mem.madvise(mmap.MADV_HUGEPAGE)
+		except (AttributeError, OSError) as e:
+			# Kernels without transparent huge pages (most 32-bit Pi kernels)
+			print(f"Warning: could not use huge pages for {path}: {e}")
+		buf = np.frombuffer(mem, dtype=np.uint8).reshape(shape)
+		lock_pages(buf)
+		return buf, False
+
+	if FRAME_STORE_MODE == "memmap":
+		buf = load_frame_cache(path, conversion)
+		if buf is not None:
+			return buf, True
+
+		if os.path.exists(path + ".fb565.json"):
+			os.remove(path + ".fb565.json")
+		buf = np.memmap(path + ".fb565.tmp", dtype='uint8', mode='w+', shape=shape)
+		return buf, False
+
+	return np.empty(shape, np.dtype('uint8')), False
+
+def next_position(frame, direction, last, loop_mode):
+	# Frame (and direction) played after the given one, see IDLE_LOOP_MODE
+	next_frame = frame + direction
+
+	if 0 <= next_frame <= last:
+		return next_frame, direction
+	if loop_mode == "pingpong":
+		direction = -direction
+		return min(max(frame + direction, 0), last), direction
+	return (0 if direction > 0 else last), direction
+
+def prefetch(video, frame, direction=1, loop_mode="loop"):
+	# Ask the kernel to read the frames played after this one from disk
+	# before we need them
+	mm = backing_mmap(video)
+	if FRAME_STORE_MODE != "memmap" or mm is None:
+		return
+
+	upcoming = set()
+	for _ in range(PREFETCH_FRAMES):
+		frame, direction = next_position(frame, direction, len(video) - 1, loop_mode)
+		upcoming.add(frame)
+
+	# One madvise() per run of consecutive frames
+	ranges = []
+	for frame in sorted(upcoming):
+		if ranges and ranges[-1][0] + ranges[-1][1] == frame:
+			ranges[-1][1] += 1
+		else:
+			ranges.append([frame, 1])
+
+	frame_size = video[0].nbytes
+	for first, count in ranges:
+		start = first * frame_size
+		aligned = start - start % mmap.PAGESIZE
+		mm.madvise(mmap.MADV_WILLNEED, aligned, count * frame_size + start - aligned)
+
+def page_faults():
+	usage = resource.getrusage(resource.RUSAGE_SELF)
+	return usage.ru_minflt, usage.ru_majflt
+
+def conversion_mode(path, width, height):
+	# The direct conversion needs ffmpeg and even dimensions (U and V have
+	# half the rows and columns), otherwise fall back to OpenCV
+	if CONVERSION != "yuv":
+		return CONVERSION
+	if shutil.which("ffmpeg") is None:
+		print("Warning: ffmpeg not found, using the OpenCV conversion")
+		return "opencv"
+	if width % 2 or height % 2:
+		print(f"Warning: {path} is {width}x{height}, using the OpenCV conversion")
+		return "opencv"
+	return "yuv"
+
+def open_video(path):
+	my_video = cv2.VideoCapture(path, cv2.CAP_FFMPEG)
+	# OpenCV >= 4.5 rotates videos with rotation metadata and reports the
+	# rotated size, which wouldn't match the raw frames from ffmpeg
+	if hasattr(cv2, "CAP_PROP_ORIENTATION_AUTO"):
+		my_video.set(cv2.CAP_PROP_ORIENTATION_AUTO, 0)
+	return my_video
+
+def read_yuv420_frames(path, width, height):
+	# The FFMPEG backend of OpenCV always converts to BGR, so we ask ffmpeg
+	# for the decoder output as is. The same buffer is reused for every frame.
+	# -noautorotate keeps the frames at their stored size, the same as
+	# OpenCV reports once open_video() disabled its own auto-rotation.
+	yuv = np.empty(width * height * 3 // 2, np.dtype('uint8'))
+	proc = subprocess.Popen(
+		["ffmpeg", "-v", "error", "-noautorotate", "-i", path,
+		 "-f", "rawvideo", "-pix_fmt", "yuv420p", "-"],
+		stdout=subprocess.PIPE
+	)
+
+	try:
+		while proc.stdout.readinto(yuv) == yuv.nbytes:
+			yield yuv
+		if proc.wait() != 0:
+			raise IOError(f"Error: ffmpeg could not decode '{path}' (exit code {proc.returncode})")
+	finally:
+		proc.stdout.close()
+		if proc.poll() is None:
+			proc.kill()
+			proc.wait()
+
+class YUV420Converter():
+	# Converts YUV420 (I420) frames to RGB565 in a single stage. Each thread
+	# converts a band of rows with its own preallocated buffers, numpy releases
+	# the GIL during the computations so the bands run in parallel.
+
+	def __init__(self, width, height, threads=None):
+		threads = threads or os.cpu_count()
+
+		# Bands need an even number of rows since U and V have half the rows
+		band_height = -(-height // threads)
+		band_height += band_height % 2
+
+		self.width = width
+		self.height = height
+		self.bands = []
+		for top in range(0, height, band_height):
+			bottom = min(top + band_height, height)
+			rows = bottom - top
+			full = [np.empty((rows, width), np.int32) for _ in range(3)]
+			quarter = [np.empty((rows // 2, width // 2), np.int32) for _ in range(3)]
+			self.bands.append((top, bottom, full + quarter))
+
+		self.pool = ThreadPoolExecutor(max_workers=len(self.bands))
+
+	def convert(self, yuv, out):
+		w, h = self.width, self.height
+		y = yuv[:w * h].reshape(h, w)
+		u = yuv[w * h:w * h * 5 // 4].reshape(h // 2, w // 2)
+		v = yuv[w * h * 5 // 4:].reshape(h // 2, w // 2)
+		out = out.view('<u2').reshape(h, w)
+
+		jobs = [
+			self.pool.submit(self.convert_band, y[top:bottom], u[top // 2:bottom // 2],
+				v[top // 2:bottom // 2], out[top:bottom], scratch)
+			for top, bottom, scratch in self.bands
+		]
+		for job in jobs:
+			job.result()
+
+	@staticmethod
+	def convert_band(y, u, v, out, scratch):
+		luma, chan, packed, d, e, chroma = scratch
+		rows, width = luma.shape
+
+		# Views of the full size buffers as 2x2 blocks, so the chroma
+		# (one sample per block) can be broadcast without upsampling it first
+		blocks = (rows // 2, 2, width // 2, 2)
+		luma4 = luma.reshape(blocks)
+		chan4 = chan.reshape(blocks)
+		packed4 = packed.reshape(blocks)
+		chroma4 = chroma[:, None, :, None]
+
+		# BT.601 limited range, fixed point with 8 fractional bits
+		np.subtract(y, 16, out=luma, dtype=np.int32)
+		luma *= 298
+		luma += 128
+		np.subtract(u, 128, out=d, dtype=np.int32)
+		np.subtract(v, 128, out=e, dtype=np.int32)
+
+		# Red: 5 high bits
+		np.multiply(e, 409, out=chroma)
+		np.add(luma4, chroma4, out=packed4)
+		packed >>= 8
+		np.clip(packed, 0, 255, out=packed)
+		packed &= 0xF8
+		packed <<= 8
+
+		# Green: 6 middle bits
+		np.multiply(d, -100, out=chroma)
+		e *= 208
+		chroma -= e
+		np.add(luma4, chroma4, out=chan4)
+		chan >>= 8
+		np.clip(chan, 0, 255, out=chan)
+		chan &= 0xFC
+		chan <<= 3
+		packed |= chan
+
+		# Blue: 5 low bits
+		np.multiply(d, 516, out=chroma)
+		np.add(luma4, chroma4, out=chan4)
+		chan >>= 8
+		np.clip(chan, 0, 255, out=chan)
+		chan >>= 3
+		packed |= chan
+
+		np.copyto(out, packed, casting='unsafe')
+
+	def close(self):
+		self.pool.shutdown()
+
+def benchmark_conversion(path, frames=BENCHMARK_FRAMES):
+	my_video = open_video(path)
+	width = int(my_video.get(cv2.CAP_PROP_FRAME_WIDTH))
+	height = int(my_video.get(cv2.CAP_PROP_FRAME_HEIGHT))
+	my_video.release()
+
+	if conversion_mode(path, width, height) != "yuv":
+		print("Error: the direct conversion can't be used, nothing to compare")
+		return
+
+	print(f"Benchmarking {frames} frames of {path} ({width}x{height})\n")
+
+	# Both paths convert the same I420 frames from ffmpeg, so only
+	# the conversions are timed, not the decoding
+	out = np.empty((height, width, 2), np.dtype('uint8'))
+	converter = YUV420Converter(width, height)
+	count = 0
+	two_pass_time = 0
+	direct_time = 0
+
+	try:
+		for yuv in read_yuv420_frames(path, width, height):
+			# Current path: YUV to BGR, then BGR to BGR565
+			start = time.perf_counter()
+			frame = cv2.cvtColor(yuv.reshape(height * 3 // 2, width), cv2.COLOR_YUV2BGR_I420)
+			out[:] = cv2.cvtColor(frame, cv2.COLOR_BGR2BGR565)
+			two_pass_time += time.perf_counter() - start
+
+			# Direct path: YUV420 to RGB565 in one stage
+			start = time.perf_counter()
+			converter.convert(yuv, out)
+			direct_time += time.perf_counter() - start
+
+			count += 1
+			if count == frames:
+				break
+	except IOError as e:
+		print(e)
+	finally:
+		converter.close()
+
+	if count == 0:
+		print(f"Error: no frame decoded from {path}")
+		return
+
+	print(f"OpenCV two-pass: {two_pass_time * 1000 / count:.2f}ms/frame")
+	print(f"Direct YUV420 ({len(converter.bands)} bands): {direct_time * 1000 / count:.2f}ms/frame")
+
 def load_video(path):
 	global FPS
 
-	my_video = cv2.VideoCapture(path, cv2.CAP_FFMPEG)
+	my_video = open_video(path)
 
 	frameCount = int(my_video.get(cv2.CAP_PROP_FRAME_COUNT))
 	frameWidth = int(my_video.get(cv2.CAP_PROP_FRAME_WIDTH))
@@ -29,24 +368,103 @@ def load_video(path):
 
 	FPS = int(my_video.get(cv2.CAP_PROP_FPS))
 
-	buf = np.empty((frameCount, frameHeight, frameWidth, 2), np.dtype('uint8'))
+	conversion = conversion_mode(path, frameWidth, frameHeight)
+	buf, cached = alloc_frame_store(path, (frameCount, frameHeight, frameWidth, 2), conversion)
+
+	if cached:
+		my_video.release()
+		print(f"Video {path}, using cached frames\n")
+		return buf
 
 	cur_frame = 0
 	ret = True
 
 	print(f"Loading video: {path}")
-	while cur_frame < frameCount and ret:
-		ret, frame = my_video.read()
-		cvt_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2BGR565)
-		buf[cur_frame] = cvt_frame
-		cur_frame += 1
+	if conversion == "yuv":
+		my_video.release()
 
-	my_video.release()
+		converter = YUV420Converter(frameWidth, frameHeight)
+		try:
+			for yuv in read_yuv420_frames(path, frameWidth, frameHeight):
+				converter.convert(yuv, buf[cur_frame])
+				cur_frame += 1
+				if cur_frame == frameCount:
+					break
+		except BaseException:
+			# Don't leave a half written cache behind
+			if isinstance(buf, np.memmap):
+				os.remove(path + ".fb565.tmp")
+			raise
+		finally:
+			converter.close()
+	else:
+		while cur_frame < frameCount and ret:
+			ret, frame = my_video.read()
+			if not ret:
+				break
+			cvt_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2BGR565)
+			buf[cur_frame] = cvt_frame
+			cur_frame += 1
+
+		my_video.release()
+
+	# CAP_PROP_FRAME_COUNT is only an estimate, don't keep frames we never got
+	if cur_frame == 0:
+		raise IOError(f"Error: no frame decoded from {path}")
+	if cur_frame < frameCount:
+		print(f"Warning: {path} only has {cur_frame} of the {frameCount} announced frames")
+		buf = buf[:cur_frame]
+
+	if isinstance(buf, np.memmap):
+		buf = save_frame_cache(path, buf, conversion)
 	
 	print(f"Video {path}, fully loaded\n")
 
 	return buf
 
+class Clip():
+	# A preloaded video. It has the same cue point API as the streaming players
+	# but seeking is only picking another frame in the frame store.
+
+	def __init__(self, path, loop_mode="loop"):
+		self.path = path
+		self.frames = load_video(path)
+		self.loop_mode = loop_mode
+		self.index = None
+		self.restart()
+
+		# Building the index runs ffprobe over the whole file, don't do it
+		# on the first trigger
+		if TRIGGER_CUE:
+			self.get_index()
+
+	def get_index(self):
+		# Only needed for cue points and timestamps
+		if self.index is None:
+			self.index = KeyframeIndex.load(self.path)
+		return self.index
+
+	def cue(self, name):
+		return self.get_index().cue(name)
+
+	def frame_at(self, seconds):
+		return self.get_index().frame_at(seconds)
+
+	def seek(self, frame):
+		self.position = min(max(frame, 0), len(self.frames) - 1)
+		self.direction = -1 if self.loop_mode == "reverse" else 1
+
+	def restart(self):
+		# Reverse clips start from their last frame
+		self.seek(len(self.frames) - 1 if self.loop_mode == "reverse" else 0)
+
+	def frame(self):
+		return self.frames[self.position]
+
+	def advance(self):
+		self.position, self.direction = next_position(
+			self.position, self.direction, len(self.frames) - 1, self.loop_mode)
+
 def main():
 	# GPIO init
 	GPIO.setmode(GPIO.BOARD)
@@ -54,8 +472,8 @@ def main():
 
 	print("Loading videos:\n")
 
-	video1 = load_video("video1.mp4")
-	video2 = load_video("video2.mp4")
+	video1 = Clip("video1.mp4", IDLE_LOOP_MODE)
+	video2 = Clip("video2.mp4", TRIGGER_LOOP_MODE)
 
 	# This was not explained in the video, but without this
 	# you will see the blinking cursor of the terminal
@@ -68,22 +486,37 @@ def main():
 	fb_map = np.memmap("/dev/fb0", dtype='uint8',mode='r+', shape=(1080,1920,2))
 
 	current_video = video1
-	current_frame = 0
 
 	last_frame_ts = 0
 
+	last_faults = page_faults()
+	last_faults_ts = time.perf_counter()
+
+	for video in (video1, video2):
+		mm = backing_mmap(video.frames)
+		if FRAME_STORE_MODE == "memmap" and mm is not None:
+			# SEQUENTIAL drops the frames just played, only fine when
+			# the clip never plays backwards
+			mm.madvise(mmap.MADV_SEQUENTIAL if video.loop_mode == "loop" else mmap.MADV_NORMAL)
+
 	while True:
 		triggered = check_sensor_state()
 
 		if triggered and current_video is video1:
-			current_frame = 0
 			current_video = video2
+			if TRIGGER_CUE:
+				current_video.seek(video2.cue(TRIGGER_CUE))
+			else:
+				current_video.restart()
 		elif not triggered and current_video is video2:
-			current_frame = 0
 			current_video = video1
+			if not RESUME_IDLE:
+				current_video.restart()
 
 		fcntl.ioctl(fb_fd, FBIO_WAITFORVSYNC)
-		fb_map[:] = current_video[current_frame]
+		fb_map[:] = current_video.frame()
+		prefetch(current_video.frames, current_video.position, current_video.direction,
+			current_video.loop_mode)
 
 		since_last = time.perf_counter() - last_frame_ts
 		to_wait = (1/FPS) - since_last
@@ -95,9 +528,22 @@ def main():
 
 		last_frame_ts = time.perf_counter()
 
-		current_frame += 1
-		if current_frame == len(current_video):
-			current_frame = 0
+		# Page faults during playback are the stalls we are trying to avoid.
+		# Major faults wait for the disk, minor ones only map a page already in RAM
+		# (in memmap mode the prefetched frames still take those).
+		if last_frame_ts - last_faults_ts >= 1:
+			faults = page_faults()
+			elapsed = last_frame_ts - last_faults_ts
+			print(f"Page faults/s: {(faults[0] - last_faults[0]) / elapsed:.0f} minor, "
+				f"{(faults[1] - last_faults[1]) / elapsed:.0f} major")
+			last_faults = faults
+			last_faults_ts = last_frame_ts
+
+		current_video.advance()
 
 if __name__ == '__main__':
-	main()
\ No newline at end of file
+	# python3 05_opencv_fb.py --benchmark video1.mp4
+	if len(sys.argv) > 2 and sys.argv[1] == "--benchmark":
+		benchmark_conversion(sys.argv[2])
+	else:
+		main()
\ No newline at end of file
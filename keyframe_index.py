@@ -0,0 +1,143 @@
+import bisect
+import json
+import os
+import subprocess
+from typing import Dict, List, Optional
+
+# Bump this when the layout of the cache file changes
+INDEX_VERSION = 1
+INDEX_SUFFIX = ".kfindex.json"
+
+class KeyframeIndex:
+    """
+    Keyframe positions, frame timestamps and named cue points of a video file.
+
+    The index is built once with ffprobe (no decoding, only the packets are read)
+    and cached next to the media as <video>.kfindex.json. It is rebuilt when the
+    video file changes, the cue points still in the video are kept.
+
+    Frames are numbered in presentation order, starting at 0.
+    """
+
+    def __init__(self, video_path: str, timestamps: List[float], keyframes: List[int],
+                 cues: Optional[Dict[str, int]] = None) -> None:
+        self.video_path = video_path
+        self.timestamps = timestamps
+        self.keyframes = keyframes
+        self.cues = cues or {}
+
+    @classmethod
+    def load(cls, video_path: str) -> "KeyframeIndex":
+        """
+        Loads the cached index of a video, building it first if it's missing, outdated
+        or can't be read.
+
+        Args:
+            video_path: Path to the video file.
+        """
+        cache_path = video_path + INDEX_SUFFIX
+        stat = os.stat(video_path)
+        cues = None
+
+        if os.path.exists(cache_path):
+            try:
+                with open(cache_path) as f:
+                    data = json.load(f)
+                cues = data.get("cues")
+                if (data.get("version") == INDEX_VERSION and data.get("size") == stat.st_size
+                        and data.get("mtime") == stat.st_mtime):
+                    return cls(video_path, data["timestamps"], data["keyframes"], cues)
+                print(f"Keyframe index of '{video_path}' is outdated, rebuilding it")
+            except (ValueError, KeyError, AttributeError) as e:
+                print(f"Warning: Keyframe index of '{video_path}' can't be read ({e}), rebuilding it")
+                cues = None
+
+        index = cls.build(video_path)
+        # Keep the cue points of the previous index that still exist in the video
+        for name, frame in (cues or {}).items():
+            if isinstance(frame, int) and 0 <= frame < index.frame_count:
+                index.cues[name] = frame
+            else:
+                print(f"Warning: Dropping cue point '{name}' (frame {frame}), "
+                      f"'{video_path}' only has {index.frame_count} frames")
+        index.save()
+        return index
+
+    @classmethod
+    def build(cls, video_path: str) -> "KeyframeIndex":
+        """
+        Builds the index of a video with ffprobe.
+
+        Args:
+            video_path: Path to the video file.
+        """
+        print(f"Building keyframe index of '{video_path}'")
+        output = subprocess.run(
+            ["ffprobe", "-v", "error", "-select_streams", "v:0",
+             "-show_entries", "packet=pts_time,flags", "-of", "csv=print_section=0", video_path],
+            check=True, capture_output=True, text=True
+        ).stdout
+
+        # Packets come in decoding order, sort them to get the presentation order
+        packets = []
+        for line in output.splitlines():
+            fields = line.strip().split(",")
+            if len(fields) < 2 or fields[0] == "N/A":
+                continue
+            packets.append((float(fields[0]), "K" in fields[1]))
+        packets.sort()
+
+        if not packets:
+            raise IOError(f"Error: No video frames found in '{video_path}'")
+
+        timestamps = [pts for pts, _ in packets]
+        keyframes = [frame for frame, (_, key) in enumerate(packets) if key]
+        # The first frame can always be decoded when starting from the beginning
+        if not keyframes or keyframes[0] != 0:
+            keyframes.insert(0, 0)
+
+        return cls(video_path, timestamps, keyframes)
+
+    def save(self) -> None:
+        stat = os.stat(self.video_path)
+        data = {
+            "version": INDEX_VERSION,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "timestamps": self.timestamps,
+            "keyframes": self.keyframes,
+            "cues": self.cues,
+        }
+        with open(self.video_path + INDEX_SUFFIX, "w") as f:
+            json.dump(data, f)
+
+    @property
+    def frame_count(self) -> int:
+        return len(self.timestamps)
+
+    def keyframe_before(self, frame: int) -> int:
+        """Returns the closest keyframe at or before the given frame."""
+        return self.keyframes[bisect.bisect_right(self.keyframes, frame) - 1]
+
+    def time_of(self, frame: int) -> float:
+        """Returns the time of a frame in seconds, from the first frame of the video."""
+        if not 0 <= frame < self.frame_count:
+            raise ValueError(f"Error: Frame {frame} is out of range (0-{self.frame_count - 1})")
+        return self.timestamps[frame] - self.timestamps[0]
+
+    def frame_at(self, seconds: float) -> int:
+        """Returns the frame displayed at the given time (in seconds from the first frame)."""
+        frame = bisect.bisect_right(self.timestamps, self.timestamps[0] + seconds) - 1
+        return min(max(frame, 0), self.frame_count - 1)
+
+    def add_cue(self, name: str, frame: int) -> None:
+        """Names a frame so triggers can jump to it. Call save() to keep it."""
+        if not 0 <= frame < self.frame_count:
+            raise ValueError(f"Error: Frame {frame} is out of range (0-{self.frame_count - 1})")
+        self.cues[name] = frame
+
+    def cue(self, name: str) -> int:
+        """Returns the frame of a cue point."""
+        if name not in self.cues:
+            raise KeyError(f"Error: No cue point named '{name}' in '{self.video_path}'")
+        return self.cues[name]